@@ -5,10 +5,12 @@
 
 import unittest
 import test_agent
+import test_rule
 
 def main():
     print("Wazuh HIDS Library Tests")
     agent_suite = test_agent.load_tests()
-    alltests = unittest.TestSuite([agent_suite])
+    rule_suite = test_rule.load_tests()
+    alltests = unittest.TestSuite([agent_suite, rule_suite])
     unittest.TextTestRunner(verbosity=2).run(alltests)
     # print(alltests.run(unittest.TestResult()))
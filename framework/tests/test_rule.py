@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+# Created by Wazuh, Inc. <info@wazuh.com>.
+# This program is a free software; you can redistribute it and/or modify it under the terms of GPLv2
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import json
+
+sys.path.insert(0, os.path.abspath('.'))
+from wazuh import common
+import wazuh.configuration as configuration
+import wazuh.rule as rule
+from wazuh.rule import Rule, _WrappedRuleFile
+
+RULES_A = b'''<!-- SSHD rules -- test -->
+<group name="syslog,sshd,">
+  <rule id="5700" level="0" noalert="1">
+    <decoded_as>sshd</decoded_as>
+    <description>SSHD messages grouped.</description>
+  </rule>
+  <rule id="5701" level="8">
+    <if_sid>5700</if_sid>
+    <description>Possible attack -- on the ssh server</description>
+    <group>recon,pci_dss_11.4,</group>
+  </rule>
+</group>
+'''
+
+RULES_B = b'''<group name="web,">
+  <rule id="31100" level="3">
+    <description>Web</description>
+    <group>pci_dss_6.5,attack</group>
+  </rule>
+</group>
+'''
+
+
+class WrappedRuleFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_wrapped(self, content):
+        path = os.path.join(self.tmp_dir, 'test_rules.xml')
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        f = _WrappedRuleFile(path)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        return data
+
+    def test_root_tag(self):
+        self.assertEqual(self.read_wrapped(b'<group name="a"/>\n'), b'<root_tag><group name="a"/>\n</root_tag>')
+
+    def test_comments_in_one_line(self):
+        self.assertEqual(self.read_wrapped(b'a<!-- x -->b<!-- y -->c\n'), b'<root_tag>abc\n</root_tag>')
+
+    def test_comment_spanning_lines(self):
+        data = self.read_wrapped(b'a<!-- x\ny\nz -->b\nc\n')
+        self.assertEqual(data, b'<root_tag>a\n\nb\nc\n</root_tag>')
+
+    def test_comment_keeps_newlines(self):
+        data = self.read_wrapped(b'<!-- 1\n2\n3\n-->\n<a/>\n')
+        self.assertEqual(data.count(b'\n'), 5)
+
+    def test_dashes_in_comment(self):
+        self.assertEqual(self.read_wrapped(b'<!-- a -- b--c -->\n'), b'<root_tag>\n</root_tag>')
+
+    def test_dashes_in_text(self):
+        content = b'<description>a -- b</description>\n'
+        self.assertEqual(self.read_wrapped(content), b'<root_tag>' + content + b'</root_tag>')
+
+    def test_read_size(self):
+        path = os.path.join(self.tmp_dir, 'test_rules.xml')
+        with open(path, 'wb') as f:
+            f.write(b'<a/>\n' * 100)
+
+        f = _WrappedRuleFile(path)
+        try:
+            chunks = []
+            chunk = f.read(64)
+            while chunk:
+                chunks.append(chunk)
+                chunk = f.read(64)
+        finally:
+            f.close()
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), b'<root_tag>' + b'<a/>\n' * 100 + b'</root_tag>')
+
+
+class RulesCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.ossec_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.ossec_path, 'rules'))
+        self.write_rules('a_rules.xml', RULES_A)
+        self.write_rules('b_rules.xml', RULES_B)
+
+        self.includes = ['a_rules.xml', 'b_rules.xml']
+        self.get_ossec_conf = configuration.get_ossec_conf
+        configuration.get_ossec_conf = lambda section=None, field=None: {'rules': {'include': list(self.includes)}}
+        common.set_paths_based_on_ossec(self.ossec_path)
+        self.new_process()
+
+    def tearDown(self):
+        configuration.get_ossec_conf = self.get_ossec_conf
+        common.set_paths_based_on_ossec()
+        self.new_process()
+        shutil.rmtree(self.ossec_path)
+
+    def write_rules(self, name, content):
+        path = os.path.join(self.ossec_path, 'rules', name)
+        is_new = not os.path.exists(path)
+        with open(path, 'wb') as f:
+            f.write(content)
+        if not is_new:
+            # Make sure the mtime changes even with a coarse timer.
+            mtime = os.path.getmtime(path) + 10
+            os.utime(path, (mtime, mtime))
+
+    def new_process(self):
+        # Forget the rules kept in memory, as a new API request (process) would.
+        rule._rules_cache.clear()
+        rule._all_rules_cache.clear()
+        rule._rules_files_cache.update({'path': None, 'mtime': None, 'files': None})
+
+    def get_rules(self, status=None):
+        return [r.to_dict() for r in Rule.get_rules(status=status, limit=0)['items']]
+
+    def disable_parsing(self):
+        # Any rule file parsed from now on makes the test fail.
+        def iterparse(*args, **kwargs):
+            raise AssertionError('Rule file parsed')
+
+        self.addCleanup(setattr, rule, 'iterparse', rule.iterparse)
+        rule.iterparse = iterparse
+
+    def test_warm_cache(self):
+        cold = self.get_rules()
+        groups = Rule.get_groups()
+        pci = Rule.get_pci()
+        self.assertTrue(os.listdir(common.cache_path), 'Cache not written')
+
+        self.new_process()
+        self.disable_parsing()
+        self.assertEqual(self.get_rules(), cold)
+        self.assertEqual(Rule.get_groups(), groups)
+        self.assertEqual(Rule.get_pci(), pci)
+        self.assertEqual([r['id'] for r in cold], [5700, 5701, 31100])
+        self.assertEqual(cold[1]['description'], 'Possible attack -- on the ssh server')
+        self.assertEqual(cold[1]['groups'], ['recon', 'syslog', 'sshd'])
+        self.assertEqual(cold[1]['pci'], ['11.4'])
+
+    def test_cache_bad_key(self):
+        cold = self.get_rules()
+        cache_file = os.path.join(common.cache_path, 'wazuh_rules_all.json')
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+
+        # Cached rules with a bad key must be ignored
+        cache['key'] = 'bad'
+        cache['rules'] = cache['rules'][:1]
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+
+        self.new_process()
+        self.assertEqual(self.get_rules(), cold)
+
+        with open(cache_file, 'r') as f:
+            self.assertNotEqual(json.load(f)['key'], 'bad')
+
+    def test_cache_invalid_json(self):
+        cold = self.get_rules()
+        with open(os.path.join(common.cache_path, 'wazuh_rules_all.json'), 'w') as f:
+            f.write('{"key": ')
+
+        self.new_process()
+        self.assertEqual(self.get_rules(), cold)
+
+    def test_rule_file_modified(self):
+        self.get_rules()
+        self.new_process()
+
+        self.write_rules('b_rules.xml', RULES_B.replace(b'level="3"', b'level="5"'))
+        self.new_process()
+        self.assertEqual([r['level'] for r in self.get_rules() if r['id'] == 31100], [5])
+
+    def test_include_changed(self):
+        self.assertEqual([r['status'] for r in self.get_rules()], ['enabled', 'enabled', 'enabled'])
+        self.assertEqual(len(self.get_rules(status='enabled')), 3)
+        self.new_process()
+
+        self.includes.remove('b_rules.xml')
+        self.new_process()
+        self.assertEqual([(r['id'], r['status']) for r in self.get_rules()], [(5700, 'enabled'), (5701, 'enabled'), (31100, 'disabled')])
+        self.assertEqual([r['id'] for r in self.get_rules(status='enabled')], [5700, 5701])
+        self.new_process()
+
+        self.includes.append('b_rules.xml')
+        self.new_process()
+        self.assertEqual([r['status'] for r in self.get_rules()], ['enabled', 'enabled', 'enabled'])
+        self.assertEqual(len(self.get_rules(status='enabled')), 3)
+
+    def test_duplicated_include(self):
+        self.includes.append('a_rules.xml')
+        for status in ['enabled', 'all']:
+            self.assertEqual([f['name'] for f in Rule.get_rules_files(status=status)['items']], ['a_rules.xml', 'b_rules.xml'])
+            self.assertEqual([r['id'] for r in self.get_rules(status=status)], [5700, 5701, 31100])
+
+
+def load_tests():
+    test_cases = [WrappedRuleFileTestCase, RulesCacheTestCase]
+    suite = unittest.TestSuite()
+    for test_class in test_cases:
+        tests = unittest.TestLoader().loadTestsFromTestCase(test_class)
+        suite.addTests(tests)
+    return suite
+
+if __name__ == '__main__':
+    #unittest.main()
+    suite = load_tests()
+    unittest.TextTestRunner(verbosity=2).run(suite)
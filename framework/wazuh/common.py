@@ -28,6 +28,9 @@ def set_paths_based_on_ossec(o_path='/var/ossec'):
     global rules_path
     rules_path = '{0}/rules'.format(ossec_path)
 
+    global cache_path
+    cache_path = '{0}/var/cache'.format(ossec_path)
+
     global database_path
     database_path = ossec_path + '/var/db'
 
@@ -5,18 +5,42 @@
 
 
 from glob import glob
-from xml.etree.ElementTree import fromstring
+from itertools import chain
+from hashlib import sha1
+from time import time
+from tempfile import mkstemp
+import os
+import io
+import json
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 import wazuh.configuration as configuration
 from wazuh.exception import WazuhException
 from wazuh import common
 from wazuh.utils import cut_array, sort_array, search_array
 
+# Rules parsed by this process: {status: {'key': hash of the rule files, 'rules': array of Rule objects}}
+_rules_cache = {}
 
-class Rule:
+# Version of the cached rules. It must be increased when the parsed data of Rule changes.
+_rules_cache_version = 1
+
+# Rules returned by Rule._get_all_parsed: {status: (rules directory, timestamp, array of Rule objects)}
+_all_rules_cache = {}
+
+# Rule files found in the rules directory: {'path': rules directory, 'mtime': its mtime, 'files': array of file names}
+_rules_files_cache = {'path': None, 'mtime': None, 'files': None}
+
+
+class Rule(object):
     """
     Rule Object.
     """
 
+    __slots__ = ('file', 'description', 'id', 'level', 'status', 'groups', 'pci', '_groups_set', '_pci_set', 'details')
+
     S_ENABLED = 'enabled'
     S_DISABLED = 'disabled'
     S_ALL = 'all'
@@ -30,6 +54,8 @@ class Rule:
         self.status = None
         self.groups = []
         self.pci = []
+        self._groups_set = set()
+        self._pci_set = set()
         self.details = {}
 
     def __str__(self):
@@ -69,7 +95,7 @@ class Rule:
         :param group: Group to add (string or list)
         """
 
-        Rule.__add_unique_element(self.groups, group)
+        Rule.__add_unique_element(self.groups, self._groups_set, group)
 
     def set_pci(self, pci):
         """
@@ -77,7 +103,7 @@ class Rule:
         :param pci: Requirement to add (string or list).
         """
 
-        Rule.__add_unique_element(self.pci, pci)
+        Rule.__add_unique_element(self.pci, self._pci_set, pci)
 
     def add_detail(self, detail, value):
         """
@@ -97,18 +123,15 @@ class Rule:
             self.details[detail] = value
 
     @staticmethod
-    def __add_unique_element(src_list, element):
-        new_list = []
+    def __add_unique_element(src_list, src_set, element):
+        # src_set holds the items of src_list, to check membership in O(1).
+        items = element if isinstance(element, (list, tuple)) else (element,)
 
-        if type(element) in [list, tuple]:
-            new_list.extend(element)
-        else:
-            new_list.append(element)
-
-        for item in new_list:
+        for item in items:
             if item is not None and item != '':
                 i = item.strip()
-                if i not in src_list:
+                if i not in src_set:
+                    src_set.add(i)
                     src_list.append(i)
 
     @staticmethod
@@ -120,6 +143,22 @@ class Rule:
         else:
             raise WazuhException(1202)
 
+    @staticmethod
+    def __get_rules_dir_files():
+        # The glob is only repeated when the rules directory changes (its mtime is updated when files are added or removed).
+        try:
+            mtime = os.stat(common.rules_path).st_mtime
+        except OSError:
+            return []
+
+        if _rules_files_cache['path'] != common.rules_path or _rules_files_cache['mtime'] != mtime:
+            rule_paths = sorted(glob("{0}/*_rules.xml".format(common.rules_path)))
+            _rules_files_cache['path'] = common.rules_path
+            _rules_files_cache['mtime'] = mtime
+            _rules_files_cache['files'] = [os.path.basename(rule_path) for rule_path in rule_paths]
+
+        return _rules_files_cache['files']
+
     @staticmethod
     def get_rules_files(status=None, offset=0, limit=common.database_limit, sort=None, search=None):
         """
@@ -144,21 +183,18 @@ class Rule:
         else:
             raise WazuhException(1200)
 
+        # Duplicated includes are listed once
+        data_enabled = set(data_enabled)
+
         if status == Rule.S_ENABLED:
             for f in data_enabled:
                 data.append({'name': f, 'status': 'enabled'})
         else:
             # All rules
-            data_all = []
-            rule_paths = sorted(glob("{0}/*_rules.xml".format(common.rules_path)))
-            for rule_path in rule_paths:
-                data_all.append(rule_path.split('/')[-1])
+            data_all = set(Rule.__get_rules_dir_files())
 
             # Disabled
-            for r in data_enabled:
-                if r in data_all:
-                    data_all.remove(r)
-            for f in data_all:  # data_all = disabled
+            for f in data_all - data_enabled:
                 data.append({'name': f, 'status': 'disabled'})
 
             if status == Rule.S_ALL:
@@ -192,32 +228,31 @@ class Rule:
         :param search: Looks for items with the specified string.
         :return: Dictionary: {'items': array of items, 'totalItems': Number of items (without applying the limit)}
         """
-        all_rules = []
+        id_int = int(id) if id else None
 
+        lvl_lo, lvl_hi = None, None
         if level:
             levels = level.split('-')
-            if len(levels) < 0 or len(levels) > 2:
+            if len(levels) > 2:
                 raise WazuhException(1203)
+            try:
+                lvl_lo = int(levels[0])
+                lvl_hi = int(levels[1]) if len(levels) == 2 else lvl_lo
+            except ValueError:
+                raise WazuhException(1203)
+
+        all_rules = Rule._get_all_parsed(status)
 
-        for rule_file in Rule.get_rules_files(status=status, limit=0)['items']:
-            all_rules.extend(Rule.__load_rules_from_file(rule_file['name'], rule_file['status']))
-
-        rules = list(all_rules)
-        for r in all_rules:
-            if group and group not in r.groups:
-                rules.remove(r)
-            elif pci and pci not in r.pci:
-                rules.remove(r)
-            elif file and file != r.file:
-                rules.remove(r)
-            elif id and int(id) != r.id:
-                rules.remove(r)
-            elif level:
-                if len(levels) == 1:
-                    if int(levels[0]) != r.level:
-                        rules.remove(r)
-                elif not (int(levels[0]) <= r.level <= int(levels[1])):
-                        rules.remove(r)
+        if not (group or pci or file or id or level):
+            # Not copied: search_array and sort_array return new lists.
+            rules = all_rules
+        else:
+            rules = [r for r in all_rules
+                     if (not group or group in r.groups) and
+                        (not pci or pci in r.pci) and
+                        (not file or file == r.file) and
+                        (id_int is None or id_int == r.id) and
+                        (lvl_lo is None or lvl_lo <= r.level <= lvl_hi)]
 
         if search:
             rules = search_array(rules, search['value'], search['negation'])
@@ -229,6 +264,27 @@ class Rule:
 
         return {'items': cut_array(rules, offset, limit), 'totalItems': len(rules)}
 
+    @staticmethod
+    def _get_all_parsed(status=None, ttl=30):
+        """
+        Gets all the parsed rules, without filtering or sorting them. The list is reused for 'ttl' seconds without checking ossec.conf or the rule files again.
+
+        :param status: Filters by status: enabled, disabled, all.
+        :param ttl: Seconds to reuse the list.
+        :return: Array of Rule objects.
+        """
+        status = Rule.__check_status(status)
+
+        if status in _all_rules_cache:
+            rules_path, timestamp, rules = _all_rules_cache[status]
+            if rules_path == common.rules_path and time() - timestamp < ttl:
+                return rules
+
+        rules = Rule._load_all_cached(status, Rule.get_rules_files(status=status, limit=0)['items'])
+        _all_rules_cache[status] = (common.rules_path, time(), rules)
+
+        return rules
+
     @staticmethod
     def get_groups(offset=0, limit=common.database_limit, sort=None, search=None):
         """
@@ -240,11 +296,7 @@ class Rule:
         :param search: Looks for items with the specified string.
         :return: Dictionary: {'items': array of items, 'totalItems': Number of items (without applying the limit)}
         """
-        groups = set()
-
-        for rule in Rule.get_rules(limit=0)['items']:
-            for group in rule.groups:
-                groups.add(group)
+        groups = set().union(*(rule.groups for rule in Rule._get_all_parsed()))
 
         if search:
             groups = search_array(groups, search['value'], search['negation'])
@@ -267,11 +319,7 @@ class Rule:
         :param search: Looks for items with the specified string.
         :return: Dictionary: {'items': array of items, 'totalItems': Number of items (without applying the limit)}
         """
-        pci = set()
-
-        for rule in Rule.get_rules(limit=0)['items']:
-            for pci_item in rule.pci:
-                pci.add(pci_item)
+        pci = set().union(*(rule.pci for rule in Rule._get_all_parsed()))
 
         if search:
             pci = search_array(pci, search['value'], search['negation'])
@@ -283,65 +331,219 @@ class Rule:
 
         return {'items': cut_array(pci, offset, limit), 'totalItems': len(pci)}
 
+    @staticmethod
+    def _load_all_cached(status, rule_files):
+        """
+        Loads the rules of the specified files. Parsed rules are cached in memory and in a JSON file, both invalidated when any rule file changes.
+
+        :param status: Status used to get the rule files: enabled, disabled, all.
+        :param rule_files: Array of rule files: [{'name': file name, 'status': file status}].
+        :return: Array of Rule objects.
+        """
+        status = Rule.__check_status(status)
+
+        files_info = []
+        for rule_file in rule_files:
+            rule_path = "{0}/{1}".format(common.rules_path, rule_file['name'])
+            try:
+                files_info.append((rule_path, rule_file['status'], os.path.getmtime(rule_path), os.path.getsize(rule_path)))
+            except OSError as e:
+                raise WazuhException(1201, "{0}. Error: {1}".format(rule_file['name'], str(e)))
+
+        key = sha1(str((_rules_cache_version, files_info)).encode()).hexdigest()
+
+        if status in _rules_cache and _rules_cache[status]['key'] == key:
+            return _rules_cache[status]['rules']
+
+        # JSON instead of pickle: the cache file must not be able to run code when it is loaded.
+        cache_file = "{0}/wazuh_rules_{1}.json".format(common.cache_path, status)
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            cache = None
+
+        if isinstance(cache, dict) and cache.get('key') == key:
+            rules = [Rule.__from_dict(rule_dict) for rule_dict in cache['rules']]
+        else:
+            rules = None
+
+        if rules is None:
+            rules = list(chain.from_iterable(Rule.__load_rules_from_file(rule_file['name'], rule_file['status']) for rule_file in rule_files))
+            Rule.__write_rules_cache(cache_file, {'key': key, 'rules': [rule.to_dict() for rule in rules]})
+
+        _rules_cache[status] = {'key': key, 'rules': rules}
+
+        return rules
+
+    @staticmethod
+    def __from_dict(rule_dict):
+        rule = Rule()
+        rule.file = rule_dict['file']
+        rule.description = rule_dict['description']
+        rule.id = rule_dict['id']
+        rule.level = rule_dict['level']
+        rule.status = rule_dict['status']
+        rule.groups = rule_dict['groups']
+        rule.pci = rule_dict['pci']
+        rule._groups_set = set(rule.groups)
+        rule._pci_set = set(rule.pci)
+        rule.details = rule_dict['details']
+
+        return rule
+
+    @staticmethod
+    def __write_rules_cache(cache_file, cache):
+        # The cache is an optimization: errors writing it must not break the request.
+        try:
+            if not os.path.exists(common.cache_path):
+                os.makedirs(common.cache_path)
+
+            # A temporary file per process: concurrent requests must not write the same file.
+            fd, tmp_file = mkstemp(dir=common.cache_path)
+        except (IOError, OSError):
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                # json.dumps uses the C encoder, json.dump does not.
+                f.write(json.dumps(cache))
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError, TypeError, ValueError):
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
     @staticmethod
     def __load_rules_from_file(rule_path, rule_status):
         try:
             rules = []
-            # wrap the data
-            f = open("{0}/{1}".format(common.rules_path, rule_path))
-            data = f.read()
-            data = data.replace(" -- ", " -INVALID_CHAR ")
-            f.close()
-            xmldata = '<root_tag>' + data + '</root_tag>'
-
-            root = fromstring(xmldata)
-            for xml_group in root.getchildren():
-                if xml_group.tag.lower() == "group":
-                    general_groups = xml_group.attrib['name'].split(',')
-                    for xml_rule in xml_group.getchildren():
+            depth = 0
+            general_groups = None
+
+            # wrap the data and stream it
+            f = _WrappedRuleFile("{0}/{1}".format(common.rules_path, rule_path))
+            try:
+                for event, xml_element in iterparse(f, events=('start', 'end')):
+                    if event == 'start':
+                        depth += 1
+                        if depth == 2:
+                            if xml_element.tag.lower() == "group":
+                                general_groups = xml_element.attrib['name'].split(',')
+                            else:
+                                general_groups = None
+                        continue
+
+                    depth -= 1
+                    if depth == 1:
+                        # End of a top-level element: its rules are already processed.
+                        xml_element.clear()
+                    elif depth == 2 and general_groups is not None and xml_element.tag.lower() == "rule":
                         # New rule
-                        if xml_rule.tag.lower() == "rule":
-                            groups = []
-                            rule = Rule()
-                            rule.file = rule_path
-                            rule.id = int(xml_rule.attrib['id'])
-                            rule.level = int(xml_rule.attrib['level'])
-                            rule.status = rule_status
-
-                            for k in xml_rule.attrib:
-                                if k != 'id' and k != 'level':
-                                    rule.details[k] = xml_rule.attrib[k]
-
-                            for xml_rule_tags in xml_rule.getchildren():
-                                tag = xml_rule_tags.tag.lower()
-                                value = xml_rule_tags.text
-                                if value == None:
-                                    value = ''
-                                if tag == "group":
-                                    groups.extend(value.split(","))
-                                elif tag == "description":
-                                    rule.description += value
-                                elif tag == "field":
-                                    rule.add_detail(xml_rule_tags.attrib['name'], value)
-                                else:
-                                    rule.add_detail(tag, value)
-
-                            # Set groups
-                            groups.extend(general_groups)
-
-                            pci_groups = []
-                            ossec_groups = []
-                            for g in groups:
-                                if 'pci_dss_' in g:
-                                    pci_groups.append(g.strip()[8:])
-                                else:
-                                    ossec_groups.append(g)
-
-                            rule.set_group(ossec_groups)
-                            rule.set_pci(pci_groups)
-
-                            rules.append(rule)
+                        xml_rule = xml_element
+                        groups = []
+                        rule = Rule()
+                        rule.file = rule_path
+                        rule_attrib = xml_rule.attrib
+                        rule.id = int(rule_attrib['id'])
+                        rule.level = int(rule_attrib['level'])
+                        rule.status = rule_status
+
+                        for k in rule_attrib:
+                            if k != 'id' and k != 'level':
+                                rule.details[k] = rule_attrib[k]
+
+                        for xml_rule_tags in xml_rule:
+                            tag = xml_rule_tags.tag.lower()
+                            value = xml_rule_tags.text
+                            if value == None:
+                                value = ''
+                            if tag == "group":
+                                groups.extend(value.split(","))
+                            elif tag == "description":
+                                rule.description += value
+                            elif tag == "field":
+                                rule.add_detail(xml_rule_tags.attrib['name'], value)
+                            else:
+                                rule.add_detail(tag, value)
+
+                        # Set groups
+                        groups.extend(general_groups)
+
+                        # Same result as set_group/set_pci, without a call per item
+                        for g in groups:
+                            if 'pci_dss_' in g:
+                                g = g.strip()[8:]
+                                dst_list, dst_set = rule.pci, rule._pci_set
+                            else:
+                                dst_list, dst_set = rule.groups, rule._groups_set
+
+                            if g:
+                                g = g.strip()
+                                if g not in dst_set:
+                                    dst_set.add(g)
+                                    dst_list.append(g)
+
+                        rules.append(rule)
+                        xml_rule.clear()
+            finally:
+                f.close()
         except Exception as e:
             raise WazuhException(1201, "{0}. Error: {1}".format(rule_path, str(e)))
 
         return rules
+
+
+class _WrappedRuleFile:
+    """
+    File-like object that wraps a rule file in a root tag, so it can be streamed by iterparse.
+    """
+
+    def __init__(self, file_path):
+        # Bytes are passed to the parser as they are, expat decodes them.
+        self.f = io.open(file_path, 'rb', buffering=65536)
+        self.in_comment = False
+        lines = (self.__strip_comments(line) for line in self.f)
+        self.chunks = chain([b'<root_tag>'], lines, [b'</root_tag>'])
+
+    def __strip_comments(self, line):
+        # Comments are removed because expat does not allow '--' inside them. Lines out of comments are not copied.
+        if not self.in_comment and b'<!--' not in line:
+            return line
+
+        data = []
+        pos = 0
+        while True:
+            if self.in_comment:
+                end = line.find(b'-->', pos)
+                if end == -1:
+                    # The newline is kept, so the parser still reports the right line numbers.
+                    if line.endswith(b'\n'):
+                        data.append(b'\n')
+                    return b''.join(data)
+                pos = end + 3
+                self.in_comment = False
+            else:
+                start = line.find(b'<!--', pos)
+                if start == -1:
+                    data.append(line[pos:])
+                    return b''.join(data)
+                data.append(line[pos:start])
+                pos = start + 4
+                self.in_comment = True
+
+    def read(self, size=-1):
+        data = []
+        length = 0
+
+        for chunk in self.chunks:
+            data.append(chunk)
+            length += len(chunk)
+            if 0 < size <= length:
+                break
+
+        return b''.join(data)
+
+    def close(self):
+        self.f.close()